@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import os
 
 # ==== File paths ====
@@ -7,69 +8,100 @@ controls_path = "data/NCR-Control-Elements.csv"
 report_path = "data/ncr_max_control_vs_noncontrol_differences_with_maxes.csv"
 
 # ==== Load CSVs ====
-df_microstrain = pd.read_csv(microstrain_path)
-df_controls = pd.read_csv(controls_path)
+# Read element IDs as strings up front; strain columns stay float64 so
+# microstrain values in the thousands keep their third decimal
+microstrain_columns = pd.read_csv(microstrain_path, nrows=0).columns
+microstrain_dtype = {microstrain_columns[0]: "string"}
+
+df_microstrain = pd.read_csv(microstrain_path, dtype=microstrain_dtype, engine="c", memory_map=True, low_memory=False)
+df_controls = pd.read_csv(controls_path, dtype={"Element ID": "string"})
 
 # ==== Clean and prepare ====
-# Standardize element ID as string
+# Standardize element ID column name
 df_microstrain.rename(columns={df_microstrain.columns[0]: "Element ID"}, inplace=True)
-df_microstrain["Element ID"] = df_microstrain["Element ID"].astype(str)
-df_controls["Element ID"] = df_controls["Element ID"].astype(str)
 
 # Convert strain to microstrain starting from column F (index 5)
-df_microstrain.iloc[:, 5:] *= 1_000_000
+# Scale one contiguous (element, subcase) matrix rather than each column separately
+strain = df_microstrain.iloc[:, 5:].to_numpy(dtype=np.float64, copy=True)
+strain *= 1_000_000
+
+# Index microstrain rows by element once so each NCR is a hash lookup
+element_index = pd.Index(df_microstrain["Element ID"])
+subcases = df_microstrain.columns[5:]
 
 # Prepare output rows
 report = []
 
-# Group controls by NCR
-for ncr, group in df_controls.groupby("NCR"):
-    controls = group[group["Control"] == True]["Element ID"].tolist()
-    non_controls = group[group["Control"] == False]["Element ID"].tolist()
-
-    if not controls or not non_controls:
+# Group controls by NCR, splitting each group's elements once up front
+by_ncr = {
+    ncr: (
+        group.loc[group["Control"] == True, "Element ID"].to_numpy(),
+        group.loc[group["Control"] == False, "Element ID"].to_numpy(),
+    )
+    for ncr, group in df_controls.groupby("NCR")
+}
+
+for ncr, (controls, non_controls) in by_ncr.items():
+    if not controls.size or not non_controls.size:
         continue
 
-    # Get corresponding rows from microstrain file
-    df_ctrl = df_microstrain[df_microstrain["Element ID"].isin(controls)].set_index("Element ID")
-    df_nonctrl = df_microstrain[df_microstrain["Element ID"].isin(non_controls)].set_index("Element ID")
+    # Get corresponding rows from microstrain file, in file order; an element
+    # repeated in the microstrain file contributes all of its rows
+    ctrl_rows = element_index.get_indexer_for(controls)
+    nonctrl_rows = element_index.get_indexer_for(non_controls)
+    ctrl_rows = np.unique(ctrl_rows[ctrl_rows >= 0])
+    nonctrl_rows = np.unique(nonctrl_rows[nonctrl_rows >= 0])
 
-    if df_ctrl.empty or df_nonctrl.empty:
+    if not ctrl_rows.size or not nonctrl_rows.size:
         continue
 
-    # Transpose for subcase-wise comparison
-    df_ctrl_t = df_ctrl.iloc[:, 4:].T
-    df_nonctrl_t = df_nonctrl.iloc[:, 4:].T
+    # Strain values as (element, subcase) arrays; both share the microstrain columns
+    ctrl_arr = strain[ctrl_rows]
+    nonctrl_arr = strain[nonctrl_rows]
+
+    # The largest control/non-control gap in a subcase is always between the
+    # extremes of the two groups, so only per-subcase min/max are needed
+    ctrl_max = np.fmax.reduce(ctrl_arr, axis=0)
+    ctrl_min = np.fmin.reduce(ctrl_arr, axis=0)
+    nonctrl_max = np.fmax.reduce(nonctrl_arr, axis=0)
+    nonctrl_min = np.fmin.reduce(nonctrl_arr, axis=0)
+
+    ctrl_above = ctrl_max - nonctrl_min
+    nonctrl_above = nonctrl_max - ctrl_min
+    gap = np.fmax(ctrl_above, nonctrl_above)
+    masked = np.where(np.isnan(gap), -1, gap)
+    subcase_idx = int(np.argmax(masked))
 
     max_diff = 0
     max_subcase = None
     max_pair = (None, None)
     max_vals = (None, None)
 
-    for subcase, ctrl_row in df_ctrl_t.iterrows():
-        if subcase not in df_nonctrl_t.index:
-            continue
-        nonctrl_row = df_nonctrl_t.loc[subcase]
+    if masked[subcase_idx] > max_diff:
+        ctrl_col = ctrl_arr[:, subcase_idx]
+        nonctrl_col = nonctrl_arr[:, subcase_idx]
+        if ctrl_above[subcase_idx] >= nonctrl_above[subcase_idx]:
+            ctrl_idx, nonctrl_idx = np.nanargmax(ctrl_col), np.nanargmin(nonctrl_col)
+        else:
+            ctrl_idx, nonctrl_idx = np.nanargmin(ctrl_col), np.nanargmax(nonctrl_col)
 
-        for ctrl_elem, ctrl_val in ctrl_row.dropna().items():
-            for nonctrl_elem, nonctrl_val in nonctrl_row.dropna().items():
-                diff = abs(ctrl_val - nonctrl_val)
-                if diff > max_diff:
-                    max_diff = diff
-                    max_subcase = subcase
-                    max_pair = (ctrl_elem, nonctrl_elem)
-                    max_vals = (ctrl_val, nonctrl_val)
+        max_diff = float(gap[subcase_idx])
+        max_subcase = subcases[subcase_idx]
+        max_pair = (element_index[ctrl_rows[ctrl_idx]], element_index[nonctrl_rows[nonctrl_idx]])
+        max_vals = (float(ctrl_col[ctrl_idx]), float(nonctrl_col[nonctrl_idx]))
 
     # Get max strain and corresponding subcase for both elements across all subcases
     if max_subcase:
-        ctrl_all_subcases = df_ctrl.loc[max_pair[0]].iloc[4:].dropna()
-        nonctrl_all_subcases = df_nonctrl.loc[max_pair[1]].iloc[4:].dropna()
+        ctrl_all_subcases = ctrl_arr[ctrl_idx]
+        nonctrl_all_subcases = nonctrl_arr[nonctrl_idx]
 
-        ctrl_max_strain = ctrl_all_subcases.max()
-        ctrl_max_subcase = ctrl_all_subcases.idxmax()
+        ctrl_max_idx = np.nanargmax(ctrl_all_subcases)
+        ctrl_max_strain = float(ctrl_all_subcases[ctrl_max_idx])
+        ctrl_max_subcase = subcases[ctrl_max_idx]
 
-        nonctrl_max_strain = nonctrl_all_subcases.max()
-        nonctrl_max_subcase = nonctrl_all_subcases.idxmax()
+        nonctrl_max_idx = np.nanargmax(nonctrl_all_subcases)
+        nonctrl_max_strain = float(nonctrl_all_subcases[nonctrl_max_idx])
+        nonctrl_max_subcase = subcases[nonctrl_max_idx]
 
         report.append({
             "NCR": ncr,
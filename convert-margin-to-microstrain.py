@@ -4,32 +4,46 @@ import os
 
 input_filename = "min_tube_strain_margin_summary_by_element_subcase_pairs.csv"
 output_filename = "converted_min_tube_strain_margin_to_max_microstrain_at_dll.csv"
+CHUNK_ROWS = 100_000
 
 # Check if the file exists
 if not os.path.exists(input_filename):
     print(f"❌ Error: {input_filename} not found.")
     exit(1)
 
-print("✅ Reading CSV file...")
-df = pd.read_csv(input_filename)
-
-print("✅ File loaded. Performing conversion...")
+print("✅ Reading CSV header...")
+header = pd.read_csv(input_filename, nrows=0).columns
 
 # Fix header: replace "Min Margin" with "Max Microstrain", preserving rest of text
-df.columns = [col.replace("Min Margin", "Max Microstrain") for col in df.columns]
+output_columns = header.str.replace("Min Margin", "Max Microstrain", regex=False)
+
+print("✅ Header loaded. Converting and saving clean numeric CSV in chunks...")
+
+# Stream the file so peak memory stays at one chunk rather than the whole table
+with open(output_filename, "w", newline="") as out:
+    pd.DataFrame(columns=output_columns).to_csv(out, index=False)
 
-# Convert all rows from column B (index 1) onward to numeric
-numeric_data = pd.to_numeric(df.iloc[:, 1:].stack(), errors='coerce').unstack()
+    # Keep the label column as text; margins may contain non-numeric cells, so they are coerced below
+    reader = pd.read_csv(input_filename, dtype={header[0]: "string"}, engine="c", memory_map=True, chunksize=CHUNK_ROWS)
+    for chunk in reader:
+        chunk.columns = output_columns
 
-# Apply your formula
-converted_data = (0.00227 / (numeric_data * 1.9 + 1)) * 1_000_000
+        # Convert all rows from column B (index 1) onward to numeric
+        numeric_data = chunk.iloc[:, 1:].apply(pd.to_numeric, errors='coerce')
 
-# Replace original data in df
-df.iloc[:, 1:] = converted_data
+        # Apply your formula, 0.00227 / (margin * 1.9 + 1) * 1e6, in place on one buffer
+        converted_data = numeric_data.to_numpy(dtype=np.float64, copy=True)
+        converted_data *= 1.9
+        converted_data += 1
+        np.divide(2270.0, converted_data, out=converted_data)
 
-print("✅ Conversion complete. Saving clean numeric CSV...")
+        # Build a fresh frame rather than writing floats into columns a chunk may have parsed as int
+        converted_chunk = pd.concat(
+            [chunk.iloc[:, :1], pd.DataFrame(converted_data, index=chunk.index, columns=chunk.columns[1:])],
+            axis=1,
+        )
 
-# Save to CSV without index; this keeps Excel happy
-df.to_csv(output_filename, index=False, float_format='%.3f')
+        # Save without index; this keeps Excel happy
+        converted_chunk.to_csv(out, index=False, header=False, float_format='%.3f')
 
 print(f"✅ Done! Cleaned file saved as: {output_filename}")
@@ -2,8 +2,11 @@ import os
 import time
 import http.client
 import struct
+import threading
+import numpy as np
 from dotenv import load_dotenv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 import smtplib
 from email.message import EmailMessage
@@ -25,33 +28,61 @@ CHANNELS = {
 
 # API Authentication Server
 AUTH_SERVER = "sensorcloud.microstrain.com"
+# Socket timeout (sec) so a stalled read cannot hang a fetch worker at exit
+HTTP_TIMEOUT = 30
 PACIFIC_TZ = pytz.timezone("America/Los_Angeles")
 
+# XDR timeseries record: 8-byte timestamp (ns) followed by a 4-byte float value
+XDR_POINT_DTYPE = np.dtype([("ts", ">u8"), ("val", ">f4")])
+
+# Fetch workers live for the whole run so each keeps its HTTPS connection alive between polls
+FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+_thread_connections = threading.local()
+
 # Runtime summary trackers
 threshold_breached = False
 max_divergence = 0
 loop_gap_count = 0
-previous_timestamps = None
+previous_max_ts = None
+
+def get_connection(server):
+    connections = getattr(_thread_connections, "by_server", None)
+    if connections is None:
+        connections = _thread_connections.by_server = {}
+    if server not in connections:
+        connections[server] = http.client.HTTPSConnection(server, timeout=HTTP_TIMEOUT)
+    return connections[server]
+
+
+def https_get(server, url, headers):
+    conn = get_connection(server)
+    try:
+        conn.request("GET", url=url, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    except (http.client.HTTPException, OSError):
+        # The server may have dropped the idle keep-alive connection; reconnect once
+        conn.close()
+        conn.request("GET", url=url, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+
 
 def authenticate_key(device_id, key):
-    conn = http.client.HTTPSConnection(AUTH_SERVER)
     headers = {"Accept": "application/xdr"}
     url = f"/SensorCloud/devices/{device_id}/authenticate/?version=1&key={key}"
-    conn.request('GET', url=url, headers=headers)
-    response = conn.getresponse()
+    status, data = https_get(AUTH_SERVER, url, headers)
 
-    if response.status == http.client.OK:
-        data = response.read()
+    if status == http.client.OK:
         if len(data) < 8:
             return None, None
-        auth_token_length = struct.unpack("!I", data[:4])[0]
+        # XDR strings: 4-byte length, the bytes, then zero padding to a 4-byte boundary
+        auth_token_length = struct.unpack_from("!I", data, 0)[0]
         auth_token = data[4:4 + auth_token_length].decode('utf-8').strip('\x00')
-        server_offset = 4 + auth_token_length
-        while server_offset < len(data) - 4:
-            server_length = struct.unpack("!I", data[server_offset:server_offset + 4])[0]
-            if 1 <= server_length <= 100:
-                break
-            server_offset += 1
+        server_offset = 4 + ((auth_token_length + 3) & ~3)
+        if len(data) < server_offset + 4:
+            return None, None
+        server_length = struct.unpack_from("!I", data, server_offset)[0]
         server = data[server_offset + 4:server_offset + 4 + server_length].decode('utf-8').strip('\x00')
         return server, auth_token
     else:
@@ -59,22 +90,16 @@ def authenticate_key(device_id, key):
 
 
 def download_data_range(server, auth_token, device_id, sensor_name, channel_name, start_time_ns, end_time_ns):
-    conn = http.client.HTTPSConnection(server)
     url = f"/SensorCloud/devices/{device_id}/sensors/{sensor_name}/channels/{channel_name}/streams/timeseries/data/?version=1&auth_token={auth_token}&starttime={start_time_ns}&endtime={end_time_ns}"
     headers = {"Accept": "application/xdr"}
-    conn.request("GET", url=url, headers=headers)
-    response = conn.getresponse()
+    status, data = https_get(server, url, headers)
 
-    if response.status == http.client.OK:
-        data = response.read()
-        data_points = []
-        while data:
-            timestamp = struct.unpack_from("!Q", data, 0)[0]
-            value = struct.unpack_from("!f", data, 8)[0]
-            data_points.append((timestamp, value))
-            data = data[12:]
-        return data_points
-    return []
+    if status == http.client.OK:
+        count = len(data) // XDR_POINT_DTYPE.itemsize
+        points = np.frombuffer(data, dtype=XDR_POINT_DTYPE, count=count)
+        # One byteswap to native order; signed timestamps keep "now - ts" arithmetic safe
+        return points["ts"].astype(np.int64), points["val"].astype(np.float32)
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
 
 
 def send_email_alert(value):
@@ -94,35 +119,50 @@ def send_email_alert(value):
         print(f"❌ Failed to send email alert: {e}")
 
 
+def last_sample_per_timestamp(ts, val):
+    # np.unique reports the first occurrence, so search the reversed stream
+    unique_ts, reversed_idx = np.unique(ts[::-1], return_index=True)
+    return unique_ts, val[::-1][reversed_idx]
+
+
 def calculate_peak_difference_with_adaptive_window(server, auth_token):
     now_ns = int(time.time() * 1e9)
     start_ns = now_ns - int(10 * 60 * 1e9)
 
-    ch1_data = download_data_range(server, auth_token, DEVICE_ID, SENSOR_NAME, "ch1", start_ns, now_ns)
-    ch3_data = download_data_range(server, auth_token, DEVICE_ID, SENSOR_NAME, "ch3", start_ns, now_ns)
+    # Fetch both channels concurrently so the HTTPS round-trips overlap
+    ch1_future = FETCH_EXECUTOR.submit(download_data_range, server, auth_token, DEVICE_ID, SENSOR_NAME, "ch1", start_ns, now_ns)
+    ch3_future = FETCH_EXECUTOR.submit(download_data_range, server, auth_token, DEVICE_ID, SENSOR_NAME, "ch3", start_ns, now_ns)
+    ch1_ts, ch1_val = ch1_future.result()
+    ch3_ts, ch3_val = ch3_future.result()
 
-    if not ch1_data or not ch3_data:
-        return None, None, 0.0, set()
+    if not ch1_ts.size or not ch3_ts.size:
+        return None, None, 0.0, (None, None)
 
-    ch1_dict = dict(ch1_data)
-    ch3_dict = dict(ch3_data)
-    common_timestamps = sorted(set(ch1_dict.keys()) & set(ch3_dict.keys()))
+    # Pair ch1 and ch3 samples that share a timestamp in one sort + merge.
+    # SensorCloud streams normally arrive strictly increasing and are already
+    # unique; otherwise keep the last sample per timestamp, as a dict would.
+    if not np.all(np.diff(ch1_ts) > 0):
+        ch1_ts, ch1_val = last_sample_per_timestamp(ch1_ts, ch1_val)
+    if not np.all(np.diff(ch3_ts) > 0):
+        ch3_ts, ch3_val = last_sample_per_timestamp(ch3_ts, ch3_val)
+    common_timestamps, ch1_idx, ch3_idx = np.intersect1d(ch1_ts, ch3_ts, assume_unique=True, return_indices=True)
 
-    if not common_timestamps:
-        return None, None, 0.0, set()
+    if not common_timestamps.size:
+        return None, None, 0.0, (None, None)
 
-    matched_differences = [(ts, ch1_dict[ts] - ch3_dict[ts]) for ts in common_timestamps]
-    peak_ts, peak_val = max(matched_differences, key=lambda x: abs(x[1]))
+    matched_differences = np.subtract(ch1_val[ch1_idx], ch3_val[ch3_idx], dtype=np.float64)
+    peak_val = float(matched_differences[np.argmax(np.abs(matched_differences))])
 
-    latest_analyzed_ts = common_timestamps[-1]
+    latest_analyzed_ts = int(common_timestamps[-1])
     delay_to_latest_data = (now_ns - latest_analyzed_ts) / 1e9
 
-    duration_sec = (max(common_timestamps) - min(common_timestamps)) / 1e9
-    return peak_val, delay_to_latest_data, duration_sec, set(common_timestamps)
+    earliest_analyzed_ts = int(common_timestamps[0])
+    duration_sec = (latest_analyzed_ts - earliest_analyzed_ts) / 1e9
+    return peak_val, delay_to_latest_data, duration_sec, (earliest_analyzed_ts, latest_analyzed_ts)
 
 
 def main():
-    global threshold_breached, max_divergence, loop_gap_count, previous_timestamps
+    global threshold_breached, max_divergence, loop_gap_count, previous_max_ts
 
     server, auth_token = authenticate_key(DEVICE_ID, AUTH_KEY)
     if not server or not auth_token:
@@ -134,20 +174,21 @@ def main():
 
     try:
         while True:
-            peak_difference, delay, duration_sec, current_timestamps = calculate_peak_difference_with_adaptive_window(server, auth_token)
+            peak_difference, delay, duration_sec, (window_start_ts, window_end_ts) = calculate_peak_difference_with_adaptive_window(server, auth_token)
 
             if peak_difference is not None:
                 abs_diff = abs(peak_difference)
                 overlap_status = ""
 
-                if previous_timestamps is not None:
-                    if previous_timestamps & current_timestamps:
+                # Windows overlap when this one starts before the previous one ended
+                if previous_max_ts is not None:
+                    if window_start_ts <= previous_max_ts:
                         overlap_status = "✅ No data gap detected"
                     else:
                         overlap_status = "⚠️ Timestamp gap detected"
                         loop_gap_count += 1
 
-                previous_timestamps = current_timestamps
+                previous_max_ts = window_end_ts
 
                 if abs_diff > THRESHOLD:
                     print(f"\U0001F6A8 Divergence ABOVE threshold: {abs_diff:.2f} (Delay to latest data: {delay:.1f} sec, Analyzed Window: Last {duration_sec / 60:.2f} min) {overlap_status}")
@@ -1,10 +1,17 @@
+import io
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
+import csv
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
+from matplotlib.figure import Figure
+from matplotlib.dates import DateFormatter
 from fpdf import FPDF
+from fpdf.enums import XPos, YPos
 from datetime import datetime
 import pytz
 import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 # Define folders
@@ -12,17 +19,24 @@ DATA_DIR = "data"
 REPORTS_DIR = "reports"
 KEY_FILE = "NCR-Control-Elements.csv"
 PACIFIC_TZ = pytz.timezone("America/Los_Angeles")
+PLOT_BUCKETS = 1000
+PLOT_DPI = 150
+HEADER_SCAN_BYTES = 8192
+CONTROL_FLAGS = {'true': True, 'false': False}
 
 # Ensure report directory exists
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
-# Load key file
+# Load key file as a list of row dicts with normalized headers and a boolean control flag
 def load_key_file():
     key_path = os.path.join(DATA_DIR, KEY_FILE)
-    key_df = pd.read_csv(key_path)
-    key_df.columns = key_df.columns.str.strip().str.lower()
-    key_df['control'] = key_df['control'].astype(str).str.strip().str.lower().map({'true': True, 'false': False})
-    return key_df
+    # utf-8-sig drops the BOM that Excel puts in front of the first header
+    with open(key_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is None:
+            raise ValueError(f"Key file {key_path} is empty")
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        return [dict(r, control=CONTROL_FLAGS.get((r['control'] or '').strip().lower())) for r in reader]
 
 # Select file from data folder
 def select_data_file():
@@ -33,66 +47,147 @@ def select_data_file():
     choice = int(input("Select a file number: ")) - 1
     return os.path.join(DATA_DIR, files[choice])
 
-# Load data skipping metadata
+# Count the metadata rows above the 'Time,...' header line
+def count_metadata_rows(filepath):
+    with open(filepath, 'rb') as f:
+        head = f.read(HEADER_SCAN_BYTES)
+    for row, line in enumerate(head.split(b'\n')):
+        if line.strip().startswith(b'Time,'):
+            return row
+    raise ValueError(f"No 'Time' header row in the first {HEADER_SCAN_BYTES} bytes of {filepath}")
+
+# Load data skipping metadata, as a dict of column name -> ndarray (Time in UTC epoch ns)
 def load_data(filepath, ncr_channel, ctrl_channel):
-    dtype_spec = {
-        'Time': 'int64',
-        ncr_channel: 'float32',
-        ctrl_channel: 'float32',
+    metadata_rows = count_metadata_rows(filepath)
+    column_types = {
+        'Time': pa.int64(),
+        ncr_channel: pa.float32(),
+        ctrl_channel: pa.float32(),
     }
-    df = pd.read_csv(filepath, skiprows=18, usecols=['Time', ncr_channel, ctrl_channel], dtype=dtype_spec)
-    df.columns = df.columns.str.strip()
-    df = df.dropna(subset=['Time'])
-    df = df[df['Time'] > 0]
-    df['Time'] = pd.to_datetime(df['Time'], unit='ns', utc=True)
-    return df
+    # Parse straight out of a memory-mapped view of the file, no intermediate read buffer
+    with pa.memory_map(filepath, 'r') as source:
+        table = pacsv.read_csv(
+            source,
+            read_options=pacsv.ReadOptions(skip_rows=metadata_rows, block_size=8 << 20, use_threads=True),
+            # Skip ragged rows, e.g. a partial last line of a log still being written
+            parse_options=pacsv.ParseOptions(delimiter=',', invalid_row_handler=lambda row: 'skip'),
+            convert_options=pacsv.ConvertOptions(include_columns=list(column_types), column_types=column_types),
+        )
+    # Drops null and non-positive times
+    table = table.filter(pc.greater(table['Time'], 0))
+    return {name.strip(): table[name].to_numpy() for name in table.column_names}
 
 # Match data channels to key file
-def identify_channels(key_df):
-    ncr_row = key_df[key_df['control'] == False].iloc[0]
-    ctrl_row = key_df[key_df['control'] == True].iloc[0]
+def identify_channels(key_rows):
+    ncr_row = next(r for r in key_rows if r['control'] is False)
+    ctrl_row = next(r for r in key_rows if r['control'] is True)
     return (ncr_row, ctrl_row)
 
-# Generate and save plots
-def create_plots(df, ncr, ctrl, filename):
-    from matplotlib.dates import DateFormatter
-    timestamps = df['Time'].dt.tz_convert(PACIFIC_TZ)
+# Convert a UTC epoch nanosecond timestamp to a Pacific datetime
+def to_pacific(t_ns):
+    return datetime.fromtimestamp(t_ns / 1e9, tz=PACIFIC_TZ)
+
+# Mean of the finite values, NaN when there are none
+def finite_mean(values):
+    values = values[np.isfinite(values)]
+    return values.mean() if values.size else float('nan')
+
+# Time derivative by central differences, one-sided at the ends; np.gradient only for uneven sampling
+def central_slope(values, time_sec):
+    dt_all = np.diff(time_sec)
+    dt = dt_all[0]
+    if not np.allclose(dt_all, dt):
+        return np.gradient(values, time_sec)
+    slope = np.empty(values.shape, dtype=np.float64)
+    np.subtract(values[2:], values[:-2], out=slope[1:-1])
+    slope[1:-1] /= 2 * dt
+    slope[0] = (values[1] - values[0]) / dt
+    slope[-1] = (values[-1] - values[-2]) / dt
+    return slope
+
+# Compute divergence, NCR slope and their summary stats once for both the plots and the PDF
+def compute_signals(data, ncr, ctrl):
     ncr_channel = ncr['channel']
     ctrl_channel = ctrl['channel']
-    divergence = df[ncr_channel] - df[ctrl_channel]
-    peak_idx = divergence.abs().idxmax()
-    peak_time = df.loc[peak_idx, 'Time'].tz_convert(PACIFIC_TZ)
+    divergence = data[ncr_channel] - data[ctrl_channel]
+    abs_divergence = np.abs(divergence)
+    peak_idx = int(np.nanargmax(abs_divergence))
+
+    t_ns = data['Time']
+    time_sec = (t_ns - t_ns[0]) * 1e-9
+    slope = central_slope(data[ncr_channel], time_sec)
+    abs_slope = np.abs(slope)
+    max_slope_idx = int(np.argmax(abs_slope))
+
+    return {
+        'divergence': divergence,
+        'peak_idx': peak_idx,
+        'peak_div': abs_divergence[peak_idx],
+        'pre_avg': finite_mean(abs_divergence[:peak_idx]),
+        'post_avg': finite_mean(abs_divergence[peak_idx+1:]),
+        'max_slope_idx': max_slope_idx,
+        'max_slope': abs_slope[max_slope_idx],
+    }
+
+# Pick per-bucket min/max sample indices so dense signals plot quickly but keep their peaks
+def decimation_indices(series_list, n_buckets=PLOT_BUCKETS):
+    n = len(series_list[0])
+    bucket_size = n // n_buckets
+    if bucket_size < 4:
+        return np.arange(n)
+
+    usable = bucket_size * n_buckets
+    offsets = np.arange(n_buckets) * bucket_size
+    keep = [np.array([0, n - 1]), np.arange(usable, n)]
+    for values in series_list:
+        buckets = np.asarray(values[:usable], dtype=np.float64).reshape(n_buckets, bucket_size)
+        missing = np.isnan(buckets)
+        keep.append(offsets + np.argmax(np.where(missing, -np.inf, buckets), axis=1))
+        keep.append(offsets + np.argmin(np.where(missing, np.inf, buckets), axis=1))
+    return np.unique(np.concatenate(keep))
+
+# Generate plots as an in-memory JPEG for the PDF
+def create_plots(data, ncr, ctrl, signals):
+    t_ns = data['Time']
+    ncr_values = data[ncr['channel']]
+    ctrl_values = data[ctrl['channel']]
+    divergence = signals['divergence']
+    peak_idx = signals['peak_idx']
+    peak_time = to_pacific(t_ns[peak_idx])
 
     ncr_label = f"NCR ({ncr['element id']})"
     ctrl_label = f"Control ({ctrl['element id']})"
-    combined_plot_path = os.path.join(REPORTS_DIR, filename + "_combined.png")
-    fig, axs = plt.subplots(2, 1, figsize=(8, 8), dpi=300)
+    # A standalone Figure keeps the worker thread off pyplot's global state
+    fig = Figure(figsize=(8, 8), dpi=PLOT_DPI)
+    axs = fig.subplots(2, 1)
+
+    # Plot decimated lines; peak and slope annotations below still use the full data
+    plot_idx = decimation_indices([ncr_values, ctrl_values, divergence])
+    plot_times = t_ns[plot_idx].astype('datetime64[ns]')
 
     # Plot 1: Strain vs Time
-    axs[0].plot(timestamps, df[ncr_channel], label=ncr_label)
-    axs[0].plot(timestamps, df[ctrl_channel], label=ctrl_label)
+    axs[0].plot(plot_times, ncr_values[plot_idx], label=ncr_label, rasterized=True)
+    axs[0].plot(plot_times, ctrl_values[plot_idx], label=ctrl_label, rasterized=True)
     axs[0].set_title("Strain vs Time")
     axs[0].set_xlabel("Time")
     axs[0].set_ylabel("Strain")
     axs[0].axvline(x=peak_time, color='black', linestyle='--', linewidth=1)
-    axs[0].annotate('Peak Divergence', xy=(peak_time, df[ncr_channel].loc[peak_idx]), xytext=(10, 10), textcoords='offset points', arrowprops=dict(arrowstyle='->'), fontsize=8)
+    axs[0].annotate('Peak Divergence', xy=(peak_time, ncr_values[peak_idx]), xytext=(10, 10), textcoords='offset points', arrowprops=dict(arrowstyle='->'), fontsize=8)
 
     # Annotate steepest slope location on NCR signal only
-    time_sec = (df['Time'] - df['Time'].iloc[0]).dt.total_seconds().values
-    slope = np.gradient(df[ncr_channel].values, time_sec[:len(df)])
-    max_slope_idx = np.argmax(np.abs(slope))
-    slope_time = df['Time'].iloc[max_slope_idx].tz_convert(PACIFIC_TZ)
+    max_slope_idx = signals['max_slope_idx']
+    slope_time = to_pacific(t_ns[max_slope_idx])
     axs[0].axvline(x=slope_time, color='blue', linestyle='--', linewidth=1)
-    axs[0].annotate('Steepest Slope', xy=(slope_time, df[ncr_channel].iloc[max_slope_idx]), xytext=(-40, 15), textcoords='offset points', arrowprops=dict(arrowstyle='->'), fontsize=8)
+    axs[0].annotate('Steepest Slope', xy=(slope_time, ncr_values[max_slope_idx]), xytext=(-40, 15), textcoords='offset points', arrowprops=dict(arrowstyle='->'), fontsize=8)
 
     axs[0].legend()
     axs[0].xaxis.set_major_formatter(DateFormatter('%H:%M', tz=PACIFIC_TZ))
     axs[0].tick_params(axis='x', rotation=45)
 
     # Plot 2: Divergence
-    axs[1].plot(timestamps, divergence, label="Divergence (NCR - Control)", color='red')
+    axs[1].plot(plot_times, divergence[plot_idx], label="Divergence (NCR - Control)", color='red', rasterized=True)
     axs[1].axvline(x=peak_time, color='black', linestyle='--', linewidth=1)
-    axs[1].annotate('Peak Divergence', xy=(peak_time, divergence.loc[peak_idx]), xytext=(10, 10), textcoords='offset points', arrowprops=dict(arrowstyle='->'), fontsize=8)
+    axs[1].annotate('Peak Divergence', xy=(peak_time, divergence[peak_idx]), xytext=(10, 10), textcoords='offset points', arrowprops=dict(arrowstyle='->'), fontsize=8)
     axs[1].set_title("Strain Divergence vs Time")
     axs[1].set_xlabel("Time")
     axs[1].set_ylabel("Strain Divergence")
@@ -100,76 +195,74 @@ def create_plots(df, ncr, ctrl, filename):
     axs[1].xaxis.set_major_formatter(DateFormatter('%H:%M', tz=PACIFIC_TZ))
     axs[1].tick_params(axis='x', rotation=45)
 
-    plt.tight_layout()
-    plt.savefig(combined_plot_path, bbox_inches='tight')
-    plt.close()
-    return combined_plot_path, slope, divergence
+    fig.tight_layout()
+    plot_image = io.BytesIO()
+    fig.savefig(plot_image, format='jpeg', bbox_inches='tight', dpi=PLOT_DPI, pil_kwargs={'quality': 85, 'optimize': True, 'progressive': True})
+    plot_image.seek(0)
+    return plot_image
 
-# Generate PDF Report
-def generate_pdf(ncr, ctrl, df, divergence, plots, filename):
-    ncr_number = str(ncr.iloc[0]).strip()
+# Build the PDF text sections; returns the document and its report file name
+def build_pdf_text(ncr, ctrl, data, signals, filename):
+    ncr_number = next(iter(ncr.values())).strip()
     clean_title = f"Strain Monitoring Report for NCR {ncr_number}" if not ncr_number.startswith("NCR") else f"Strain Monitoring Report for {ncr_number}"
     clean_filename = f"{filename}_report_{ncr_number.replace(' ', '_').replace('/', '-')}.pdf"
 
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.add_page()
-    pdf.set_font("Arial", 'B', 10)
-    pdf.cell(0, 5, clean_title, ln=True)
-    pdf.set_font("Arial", size=7)
-    pdf.cell(0, 4, f"Report generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", ln=True)
+    pdf.set_font("Helvetica", 'B', 10)
+    pdf.cell(0, 5, clean_title, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font("Helvetica", size=7)
+    pdf.cell(0, 4, f"Report generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
-    start_time = df['Time'].min().tz_convert(PACIFIC_TZ).strftime('%Y-%m-%d %H:%M:%S %Z')
-    end_time = df['Time'].max().tz_convert(PACIFIC_TZ).strftime('%Y-%m-%d %H:%M:%S %Z')
-    pdf.cell(0, 4, f"Data Start Time: {start_time}", ln=True)
-    pdf.cell(0, 4, f"Data End Time: {end_time}", ln=True)
+    t_ns = data['Time']
+    start_time = to_pacific(t_ns.min()).strftime('%Y-%m-%d %H:%M:%S %Z')
+    end_time = to_pacific(t_ns.max()).strftime('%Y-%m-%d %H:%M:%S %Z')
+    pdf.cell(0, 4, f"Data Start Time: {start_time}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(0, 4, f"Data End Time: {end_time}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
-    pdf.set_font("Arial", 'B', 9)
-    pdf.cell(0, 5, "Summary Statistics", ln=True)
-    pdf.set_font("Arial", size=7)
+    pdf.set_font("Helvetica", 'B', 9)
+    pdf.cell(0, 5, "Summary Statistics", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font("Helvetica", size=7)
 
     for beam, label in zip([ncr, ctrl], ["NCR", "Control"]):
         channel = beam['channel']
-        if channel in df.columns:
-            channel_data = df[channel].dropna()
-            if not channel_data.empty:
-                pdf.cell(0, 4, f"{label} Beam (Element ID: {beam['element id']})", ln=True)
-                pdf.cell(0, 4, f" - Type: {beam['type']}", ln=True)
-                pdf.cell(0, 4, f" - Peak: {channel_data.max():.2f}, Min: {channel_data.min():.2f}, Mean: {channel_data.mean():.2f}", ln=True)
+        if channel in data:
+            channel_data = data[channel][~np.isnan(data[channel])]
+            if channel_data.size:
+                pdf.cell(0, 4, f"{label} Beam (Element ID: {beam['element id']})", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+                pdf.cell(0, 4, f" - Type: {beam['type']}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+                pdf.cell(0, 4, f" - Peak: {channel_data.max():.2f}, Min: {channel_data.min():.2f}, Mean: {channel_data.mean():.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         else:
-            pdf.cell(0, 4, f"{label} Beam channel '{channel}' not found in data.", ln=True)
-
-    if not divergence.empty:
-        peak_div = divergence.abs().max()
-        peak_idx = divergence.abs().idxmax()
-        peak_time = df.loc[peak_idx, 'Time']
-        if peak_time.tzinfo is None:
-            peak_time = peak_time.tz_localize('UTC')
-        peak_time = peak_time.tz_convert(PACIFIC_TZ).strftime('%Y-%m-%d %H:%M:%S')
-
-        pre_peak = divergence[:peak_idx].dropna()
-        post_peak = divergence[peak_idx+1:].dropna()
-        pre_avg = pre_peak.abs().mean() if not pre_peak.empty else float('nan')
-        post_avg = post_peak.abs().mean() if not post_peak.empty else float('nan')
-
-        pdf.cell(0, 4, f"Peak Absolute Divergence: {peak_div:.2f}", ln=True)
-        pdf.cell(0, 4, f"Occurred at: {peak_time}", ln=True)
-        pdf.cell(0, 4, f"Average Absolute Divergence Before Peak: {pre_avg:.2f}", ln=True)
-        pdf.cell(0, 4, f"Average Absolute Divergence After Peak: {post_avg:.2f}", ln=True)
+            pdf.cell(0, 4, f"{label} Beam channel '{channel}' not found in data.", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    divergence = signals['divergence']
+    if divergence.size:
+        peak_idx = signals['peak_idx']
+        peak_div = signals['peak_div']
+        peak_time = to_pacific(t_ns[peak_idx]).strftime('%Y-%m-%d %H:%M:%S')
+
+        pre_avg = signals['pre_avg']
+        post_avg = signals['post_avg']
+
+        pdf.cell(0, 4, f"Peak Absolute Divergence: {peak_div:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.cell(0, 4, f"Occurred at: {peak_time}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.cell(0, 4, f"Average Absolute Divergence Before Peak: {pre_avg:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.cell(0, 4, f"Average Absolute Divergence After Peak: {post_avg:.2f}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
     # Max slope info for NCR only
-    ncr_channel = ncr['channel']
-    time_sec = (df['Time'] - df['Time'].iloc[0]).dt.total_seconds().values
-    slope = np.gradient(df[ncr_channel].values, time_sec[:len(df)])
-    max_slope_idx = np.argmax(np.abs(slope))
-    max_slope = np.max(np.abs(slope))
-    max_slope_time = df['Time'].iloc[max_slope_idx].tz_convert(PACIFIC_TZ).strftime('%Y-%m-%d %H:%M:%S')
-    pdf.cell(0, 4, f"Maximum Slope (NCR): {max_slope:.4f} per sec", ln=True)
-    pdf.cell(0, 4, f"Occurred at: {max_slope_time}", ln=True)
-
-    if plots[0] and os.path.exists(plots[0]):
+    max_slope_idx = signals['max_slope_idx']
+    max_slope = signals['max_slope']
+    max_slope_time = to_pacific(t_ns[max_slope_idx]).strftime('%Y-%m-%d %H:%M:%S')
+    pdf.cell(0, 4, f"Maximum Slope (NCR): {max_slope:.4f} per sec", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(0, 4, f"Occurred at: {max_slope_time}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    return pdf, clean_filename
+
+# Append the plot image and write the PDF Report
+def save_pdf(pdf, plot_image, clean_filename):
+    if plot_image is not None:
         pdf.ln(1)
-        pdf.image(plots[0], x=10, w=190)
+        pdf.image(plot_image, x=10, w=190)
 
     report_file = os.path.join(REPORTS_DIR, clean_filename)
     pdf.output(report_file)
@@ -178,26 +271,33 @@ def generate_pdf(ncr, ctrl, df, divergence, plots, filename):
 # Main function
 def main():
     start = time.time()
-    key_df = load_key_file()
+    key_rows = load_key_file()
     print(f"Loaded key file in {time.time() - start:.2f} sec")
 
     filepath = select_data_file()
     filename = os.path.splitext(os.path.basename(filepath))[0]
 
     start = time.time()
-    ncr, ctrl = identify_channels(key_df)
+    ncr, ctrl = identify_channels(key_rows)
     print(f"Identified channels in {time.time() - start:.2f} sec")
 
     start = time.time()
-    df = load_data(filepath, ncr['channel'], ctrl['channel'])
+    data = load_data(filepath, ncr['channel'], ctrl['channel'])
     print(f"Loaded data file in {time.time() - start:.2f} sec")
 
     start = time.time()
-    plots_path, _, divergence = create_plots(df, ncr, ctrl, filename)
-    plots = (plots_path, None)
-    print(f"Created plots in {time.time() - start:.2f} sec")
+    signals = compute_signals(data, ncr, ctrl)
+    print(f"Computed signals in {time.time() - start:.2f} sec")
+
+    # Render the plot on a worker thread while the report text is laid out
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        plot_future = executor.submit(create_plots, data, ncr, ctrl, signals)
+        pdf, clean_filename = build_pdf_text(ncr, ctrl, data, signals, filename)
+        plot_image = plot_future.result()
+    print(f"Created plots and report text in {time.time() - start:.2f} sec")
 
-    generate_pdf(ncr, ctrl, df, divergence, plots, filename)
+    save_pdf(pdf, plot_image, clean_filename)
 
 if __name__ == "__main__":
     main()